@@ -12,8 +12,24 @@
 """
 
 import time
+import mmap
+import struct
+import asyncio
+import numpy as np
 import RPi.GPIO as gpio
-from smbus import SMBus      # This is I2C...?
+from smbus2 import SMBus, i2c_msg      # This is I2C...?
+
+# If libgpiod is installed, the kernel's GPIO character device is used to
+# wait for DRDY'; if not, RPi.GPIO does the waiting. Only version 1.5 and
+# later of the version 1 bindings are supported, as earlier ones can't turn
+# on the pull-up and version 2 has a completely different API
+try:
+    import gpiod
+    if not (hasattr (gpiod, "LINE_REQ_EV_FALLING_EDGE")
+            and hasattr (gpiod, "LINE_REQ_FLAG_BIAS_PULL_UP")):
+        gpiod = None
+except ImportError:
+    gpiod = None
 
 
 class TurboHAT:
@@ -66,12 +82,20 @@ class TurboHAT:
     ## Data rate 1000 Hz
     DR_1000HZ = 0xC0         
 
+    ## Time in milliseconds to wait for DRDY' before giving up on the ADC
+    DRDY_TIMEOUT_MS = 1000
+    ## The GPIO chip which has the DRDY' pin, used if libgpiod is available
+    GPIO_CHIP = "gpiochip0"
+    ## Offset of the BCM2835 pin level register GPLEV0 in /dev/gpiomem
+    GPLEV0 = 0x34
+
 
     def __init__ (self, i2c_bus, i2c_address=0x40, reset_pin=12, drdy_pin=16,
                   ref_voltage=VREF_SUP, data_rate=DR_20HZ):
         """! Set up the GPIO ports to talk to the ADC and save the ADC's
         address on the I2C bus.
-        @param i2c_bus The I2C bus used, created by "SMBus(1)" or similar
+        @param i2c_bus The I2C bus used, created by "smbus2.SMBus(1)" or
+               similar; it must support combined transfers via @c i2c_rdwr()
         @param i2c_address The ADC's address on the I2C bus
         @param reset_pin The GPIO pin connected to the ADC's RESET' line
         @param drdy_pin The GPIO pin connected to the ADC's DRDY' line
@@ -92,11 +116,65 @@ class TurboHAT:
         gpio.setwarnings (False)
         gpio.setmode (gpio.BCM)
         gpio.setup (self._reset_pin, gpio.OUT)
-        gpio.setup (self._drdy_pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+
+        # Ask the kernel to queue falling edges on DRDY' for us if we can,
+        # so that no edge is missed between starting a conversion and
+        # waiting for it to finish. If the kernel is too old to set the
+        # pull-up or the line can't be had, RPi.GPIO is used instead
+        self._gpio_mem = None
+        self._drdy_line = None
+        if gpiod:
+            drdy_chip = None
+            try:
+                drdy_chip = gpiod.Chip (TurboHAT.GPIO_CHIP)
+                drdy_line = drdy_chip.get_line (self._drdy_pin)
+                drdy_line.request (consumer="turbo_hat",
+                                   type=gpiod.LINE_REQ_EV_FALLING_EDGE,
+                                   flags=gpiod.LINE_REQ_FLAG_BIAS_PULL_UP)
+                self._drdy_chip = drdy_chip
+                self._drdy_line = drdy_line
+            except (OSError, AttributeError):
+                if drdy_chip is not None:
+                    drdy_chip.close ()
+
+        if self._drdy_line is None:
+            gpio.setup (self._drdy_pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+
+            # Map the GPIO registers so DRDY' can be checked with a memory
+            # read instead of a trip through RPi.GPIO. If the registers
+            # can't be mapped, RPi.GPIO is used to check it instead
+            self._drdy_mask = 1 << self._drdy_pin
+            if self._drdy_pin < 32:
+                try:
+                    with open ("/dev/gpiomem", "r+b") as gpiomem:
+                        self._gpio_mem = mmap.mmap (gpiomem.fileno (),
+                                                    TurboHAT.GPLEV0 + 4)
+                except OSError:
+                    pass
 
         # Set the RESET' pin high so the ADC will operate
         gpio.output (self._reset_pin, gpio.HIGH)
 
+        # Make the I2C messages which set the multiplexer for each
+        # single-ended channel and start a conversion; they never change.
+        # The multiplexer is only set when the channel changes
+        self._mux_messages = [
+            i2c_msg.write (self._address,
+                           [TurboHAT.CMD_WREG | (TurboHAT.REG_CFG_0 << 2),
+                            (0x08 | chan) << 4])
+            for chan in range (4)]
+        self._start_message = i2c_msg.write (self._address,
+                                             [TurboHAT.CMD_START_SYNC])
+        self._last_chan = None
+
+        # The read data command and the buffer for its result are reused too,
+        # and the bus's combined transfer method is looked up once here
+        # rather than on every transfer
+        self._rdata_message = i2c_msg.write (self._address,
+                                             [TurboHAT.CMD_RDATA])
+        self._read_message = i2c_msg.read (self._address, 2)
+        self._rdwr = self._i2c_bus.i2c_rdwr
+
         # Set the reference voltage and data rate in config. register 1
         self._i2c_bus.write_byte_data (self._address,
                         TurboHAT.CMD_WREG | (TurboHAT.REG_CFG_1 << 2),
@@ -107,6 +185,11 @@ class TurboHAT:
         """!
         Set the GPIO pins back to normal (input) mode and close the I2C bus.
         """
+        if self._drdy_line:
+            self._drdy_line.release ()
+            self._drdy_chip.close ()
+        if self._gpio_mem is not None:
+            self._gpio_mem.close ()
         gpio.cleanup ()
         self._i2c_bus.close ()
 
@@ -118,11 +201,75 @@ class TurboHAT:
         """
         for reggie in range (4):
             data = self._i2c_bus.read_byte_data (self._address,
-                       TurboHAT.CMD_RDATA | (reggie << 2))
+                       TurboHAT.CMD_RREG | (reggie << 2))
             print ("Reg {:d}: 0b{:08b}".format (reggie, data), end=' ')
         print ("")
 
 
+    def _start_messages (self, chan):
+        """! Get the I2C messages which set the multiplexer to select a
+        channel for a single-ended measurement, then send a start/sync
+        command to begin reading. Both go in one combined transfer with a
+        repeated START between them rather than as two separate bus
+        transactions. If the multiplexer was last set to the same channel,
+        only the start/sync command is sent. Otherwise the multiplexer's
+        setting is forgotten here, as a failed transfer may or may not have
+        changed it; the caller must set @c _last_chan once the messages have
+        been sent successfully.
+        @param chan The channel to read
+        @returns A list of messages for @c i2c_rdwr()
+        """
+        if (chan & 0x03) == self._last_chan:
+            return [self._start_message]
+        self._last_chan = None
+        return [self._mux_messages[chan & 0x03], self._start_message]
+
+
+    def _clear_drdy_events (self):
+        """! Throw away any DRDY' edges which the kernel has queued, such as
+        one from a conversion which finished after we gave up waiting. This
+        must be done before a conversion is started so that the next edge
+        seen is the one from that conversion.
+        """
+        if self._drdy_line:
+            while self._drdy_line.event_wait (sec=0):
+                self._drdy_line.event_read ()
+
+
+    def _drdy_is_high (self):
+        """! Check whether the DRDY' line is high, meaning that no data is
+        ready. The GPLEV0 register is read directly if it has been mapped.
+        @returns Something true if DRDY' is high, false if it's low
+        """
+        if self._gpio_mem is not None:
+            return (struct.unpack_from ('<I', self._gpio_mem,
+                                        TurboHAT.GPLEV0)[0]
+                    & self._drdy_mask)
+        return gpio.input (self._drdy_pin)
+
+
+    def _wait_for_drdy (self):
+        """! Wait for the DRDY' line to go low. The kernel blocks on the GPIO
+        interrupt rather than having us poll. With libgpiod, the edge is
+        queued even if the conversion finished before we started waiting;
+        with RPi.GPIO there's no edge to see in that case, so the level is
+        checked first
+        """
+        if self._drdy_line:
+            sec, msec = divmod (TurboHAT.DRDY_TIMEOUT_MS, 1000)
+            if not self._drdy_line.event_wait (sec=sec, nsec=msec * 1000000):
+                raise IOError ("Timeout waiting for ADS112C04")
+            self._drdy_line.event_read ()
+
+        elif self._drdy_is_high ():
+            # If DRDY' fell between checking it and starting to wait, the
+            # edge was missed; it's only a timeout if the line is still high
+            if (gpio.wait_for_edge (self._drdy_pin, gpio.FALLING,
+                                    timeout=TurboHAT.DRDY_TIMEOUT_MS) is None
+                    and self._drdy_is_high ()):
+                raise IOError ("Timeout waiting for ADS112C04")
+
+
     def read_channel (self, chan):
         """! Read one ADC channel. The value returned is a signed 16 bit
         number with the maximum corresponding to a voltage equal to the
@@ -130,15 +277,10 @@ class TurboHAT:
                    i2c-part-4---programming-i-c-with-python
         @param chan The channel to read
         """
-        # Set the multiplexer to select the correct channel for
-        # a single-ended measurement
-        self._i2c_bus.write_byte_data (self._address,
-                        TurboHAT.CMD_WREG | (TurboHAT.REG_CFG_0 << 2),
-                        (0x08 | (chan & 0x03)) << 4)
-
-        # Send a start/sync command to begin reading
-        self._i2c_bus.write_byte (self._address,
-                                 TurboHAT.CMD_START_SYNC)
+        # Select the channel and start a conversion
+        self._clear_drdy_events ()
+        self._rdwr (*self._start_messages (chan))
+        self._last_chan = chan & 0x03
 
 #         # Check the DRDY bit in configuration register 2 to see if the
 #         # conversion is complete
@@ -156,22 +298,55 @@ class TurboHAT:
 #                     raise IOError ("Timeout waiting for ADS112C04")
 #                     break
 
-        # Wait for the DRDY' line to go low
-        counter = 0
-        while gpio.input (self._drdy_pin):
-            time.sleep (0.01)
-            counter += 1
-            if counter > 100000:
-                raise IOError ("Timeout waiting for ADS112C04")
-                break
+        self._wait_for_drdy ()
+
+        # Send the read data command and read back the result, which the
+        # ADC sends most significant byte first
+        self._rdwr (self._rdata_message, self._read_message)
+        return struct.unpack ('>h', bytes (self._read_message))[0]
+
 
-        # Read and return the data, with bytes swapped
-        adc_data = self._i2c_bus.read_word_data (self._address,
-                                                TurboHAT.CMD_RDATA)
-        return ((adc_data & 0x00FF) << 8) | ((adc_data & 0xFF00) >> 8)
+    def read_channels (self, chans):
+        """! Read several ADC channels, one after another. Reading each
+        channel's result and starting the next channel's conversion are done
+        in one combined I2C transfer, so scanning the channels takes one
+        transfer per channel rather than two.
+        @param chans A sequence of the channels to read
+        @returns A NumPy array of signed 16 bit readings, one per channel
+        """
+        readings = np.empty (len (chans), dtype=np.int16)
+        if not len (chans):
+            return readings
+
+        # Keep what's used in the loop in local variables, which are quicker
+        # to get at than attributes
+        rdwr = self._rdwr
+        wait_for_drdy = self._wait_for_drdy
+        start_messages = self._start_messages
+        read = self._read_message
+        read_messages = [self._rdata_message, read]
+        unpack = struct.unpack
+
+        self._clear_drdy_events ()
+        rdwr (*start_messages (chans[0]))
+        self._last_chan = chans[0] & 0x03
+        for index in range (len (chans)):
+            wait_for_drdy ()
+
+            next_chan = self._last_chan
+            if index + 1 < len (chans):
+                next_chan = chans[index + 1] & 0x03
+                rdwr (*read_messages, *start_messages (next_chan))
+            else:
+                rdwr (*read_messages)
+            self._last_chan = next_chan
+
+            readings[index] = unpack ('>h', bytes (read))[0]
 
+        return readings
 
-def main ():
+
+async def main ():
     """! Test the ADC somehow or other. This function isn't run when 
     this driver is imported as a module.
     """
@@ -180,17 +355,19 @@ def main ():
     i2c_bus = SMBus (1)
     turbo = TurboHAT (i2c_bus, i2c_address=0x40, reset_pin=12, drdy_pin=16)
     turbo.show_ADC_registers ()
-#     turbo.show_ADC_registers ()
+
+    # Schedule readings against the monotonic clock so that the time taken
+    # to read doesn't add up into drift from one reading to the next
+    next_time = time.monotonic ()
     for count in range (20):
         ch0data = turbo.read_channel (0)
         print ("Ch 0:", ch0data)
-        time.sleep (1.0)
-
-    turbo.show_ADC_registers ()
+        next_time += 1.0
+        await asyncio.sleep (max (0.0, next_time - time.monotonic ()))
 
     turbo.clean_up ()
 
 
 if __name__ == "__main__":
-    main ()
+    asyncio.run (main ())
 
@@ -9,126 +9,427 @@
 """
 
 import io
+import sys
 import time
-from smbus import SMBus
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from smbus2 import SMBus
 import PySimpleGUI as sg
 from matplotlib.backends.backend_tkagg import FigureCanvasAgg
 from matplotlib import figure, pyplot
 from turbo_hat import TurboHAT
 
+## Event posted to the main window when a plot has been rendered
+PLOT_READY_EVENT = "-PLOT READY-"
 
-def create_plots(times, data, xlabel=None, ylabels=None,
-                 plot_titles=None, title=None):
+## What goes on one plot: a list of the ADC channels plotted on it, the label
+#  for its Y axis, its title, and a list of labels for its lines
+PlotLayout = namedtuple("PlotLayout", ["chans", "y_label", "title", "legends"])
+
+
+class SampleBuffer:
+    """!
+    This class holds the most recent samples of time and data in fixed size
+    NumPy ring buffers. When the buffers are full, each new sample replaces
+    the oldest one, so a long run can't fill up all of memory. Data is kept
+    as 32 bit floats, which is plenty for 16 bit ADC readings; times are
+    kept as 64 bit floats so they stay precise over a long run.
+    """
+
+    def __init__(self, shape, capacity=3600):
+        """!
+        Allocate the buffers, which start out empty.
+        @param shape The shape of the data in each sample, for example
+               (number of channels,)
+        @param capacity The number of samples which are kept
+        """
+        self._capacity = capacity
+        self._times = np.empty(capacity, dtype=np.float64)
+        self._data = np.empty(tuple(shape) + (capacity,), dtype=np.float32)
+        self._head = 0                 # Samples saved since last cleared
+        self._total = 0                # Samples ever saved
+
+
+    def __len__(self):
+        """!
+        @returns The number of samples currently held in the buffers
+        """
+        return min(self._head, self._capacity)
+
+
+    def total(self):
+        """!
+        @returns The number of samples ever saved, including those which
+                 have since been overwritten or cleared
+        """
+        return self._total
+
+
+    def append(self, sample_time, sample):
+        """!
+        Save a sample, overwriting the oldest one if the buffers are full.
+        @param sample_time The time at which the sample was taken
+        @param sample The data, with the shape given to the constructor
+        """
+        index = self._head % self._capacity
+        self._times[index] = sample_time
+        self._data[..., index] = sample
+        self._head += 1
+        self._total += 1
+
+
+    def clear(self):
+        """!
+        Empty the buffers except for the most recent sample.
+        """
+        if self._head:
+            newest = (self._head - 1) % self._capacity
+            self._times[0] = self._times[newest]
+            self._data[..., 0] = self._data[..., newest]
+            self._head = 1
+
+
+    def get(self):
+        """!
+        Get copies of the samples, oldest first. They're copies so that they
+        can be plotted in another thread while more samples are saved.
+        @returns A tuple holding an array of times and an array of data
+                 whose last index is the sample number
+        """
+        if self._head <= self._capacity:
+            return (self._times[:self._head].copy(),
+                    self._data[..., :self._head].copy())
+
+        split = self._head % self._capacity
+        return (np.concatenate((self._times[split:], self._times[:split])),
+                np.concatenate((self._data[..., split:],
+                                self._data[..., :split]), axis=-1))
+
+
+def build_plots(plot_layout, xlabel=None, title=None):
     """!
-    Create a plot or plots with the given time array and list of data arrays.
-    @param times An iterable of time axis coordinates
-    @param data A list of iterables of vertical axis coordinates
+    Create a plot or plots with one line for each data series. This is done
+    once at startup; update_plots() then puts new data into the lines.
+    @param plot_layout A list of @c PlotLayout tuples, one for each plot
     @param xlabel The label for the plot X axes
-    @param ylabels An iterable of labels for plot Y axes
-    @param plot_titles An iterable of titles of plots
     @param title An overall title for Life, the Universe, and Everything
-    @returns A list of figures, one for each plot
+    @returns A tuple holding a list of figures, one for each plot; a list of
+             canvases on which the figures are rendered; and a list of lists
+             of the lines on each plot
     """
     pyplot.style.use("dark_background")
 
     # Figure out how many plots' worth of data are present and set
     # up that many subplots; for each subplot there may be more than
     # one series of data
-    num_plots = len(data)
+    num_plots = len(plot_layout)
 
     figures = []
+    canvases = []
+    line_artists = []
 
     for subplot_num in range(num_plots):
         fig = figure.Figure(figsize=(5, 4), dpi=100)
 #         subplot_code = num_plots * 100 + 10 + (subplot_num + 1)
         axis = fig.add_subplot(111) ####### subplot_code)
 
-        # Plot each of the series on this plot. Serieses?
-        for series in data[subplot_num]:
-            oneline = axis.plot(times, series)
+        # Make a line for each of the channels on this plot. Serieses?
+        plot = plot_layout[subplot_num]
+        if len(plot.legends) != len(plot.chans):
+            raise ValueError("Plot '{:s}' has {:d} channels but {:d} legends"
+                             .format(plot.title, len(plot.chans),
+                                     len(plot.legends)))
+        lines = [axis.plot([], [], label=legend)[0]
+                 for legend in plot.legends]
+
+        # Show which line is which. The legend's place is fixed, as finding
+        # the best place for it means searching the data on every redraw
+        axis.legend(loc="upper left")
         if xlabel:
             axis.set_xlabel (xlabel)
-        if ylabels:
-            axis.set_ylabel (ylabels[subplot_num])
-        if plot_titles:
-            axis.set_title (plot_titles[subplot_num])
+        if plot.y_label:
+            axis.set_ylabel (plot.y_label)
+        if plot.title:
+            axis.set_title (plot.title)
 #         if title:
 #             fig.suptitle(title)
         figures.append(fig)
+        canvases.append(FigureCanvasAgg(fig))
+        line_artists.append(lines)
+
+    return figures, canvases, line_artists
+
+
+def update_plots(line_artists, plot_layout, times, data):
+    """!
+    Put the given data into the lines on the plots and rescale the axes to
+    fit. The data must not be changed afterwards, as the plots may be
+    rendered in another thread.
+    @param line_artists A list of lists of lines from build_plots()
+    @param plot_layout A list of @c PlotLayout tuples, one for each plot
+    @param times An array of time axis coordinates
+    @param data An array of data indexed by channel and sample
+    """
+    for lines, plot in zip(line_artists, plot_layout):
+        for line, chan in zip(lines, plot.chans):
+            line.set_data(times, data[chan])
+        axis = lines[0].axes
+        axis.relim()
+        axis.autoscale_view()
+
+
+def render_figure(canv, buf, window, key):
+    """!
+    Render one figure and send the image to the main window, where the event
+    loop puts it onscreen. This is run in a worker thread. The image is sent
+    as an uncompressed PPM made straight from the renderer's pixels, which
+    Tk can display without the time spent compressing and decompressing a
+    PNG.
+    @param canv The canvas on which the figure is rendered
+    @param buf A buffer, reused each time, into which the image is written
+    @param window The main window
+    @param key The key of the screen element on which the plot is drawn
+    """
+    canv.draw()
+    rgba = np.asarray(canv.buffer_rgba())
+    height, width = rgba.shape[:2]
 
-    return figures
+    buf.seek(0)
+    buf.truncate()
+    buf.write(b"P6\n%d %d\n255\n" % (width, height))
+    buf.write(rgba[:, :, :3].tobytes())
+    window.write_event_value(PLOT_READY_EVENT, (buf.getvalue(), key))
 
 
-def draw_figures(figures, elements):
+def draw_figures(canvases, buffers, elements, executor):
     """!
-    Draw the plots which have been created in create_plots().
-    @param figures A list of figures containing the plots
+    Draw the plots which have been created in build_plots(). Rendering is
+    slow, so it's done by the given executor rather than in the GUI thread.
+    @param canvases A list of canvases on which the plots are rendered
+    @param buffers A list of image buffers, one for each canvas
     @param elements The screen elements on which the plots are drawn
+    @param executor The executor which renders the plots
+    @returns A list of futures, one for each plot being rendered
     """
-    for fig, elle in zip(figures, elements):
-        canv = FigureCanvasAgg(fig)
-        buf = io.BytesIO()
-        canv.print_figure(buf, format='png')
+    return [executor.submit(render_figure, canv, buf,
+                            elle.ParentForm, elle.Key)
+            for canv, buf, elle in zip(canvases, buffers, elements)]
 
-        if buf is not None:
-            buf.seek(0)
-            data = buf.read()
-            elle.update(data=data)
 
+def print_data(times, data, plot_layout):
+    """!
+    This function prints (or displays) a set of turbine data. Each line has
+    a time followed by a reading from each channel, all separated by commas.
+    The channels are in the order in which they appear on the plots.
+    @param times An array of times
+    @param data An array of data indexed by channel and sample
+    @param plot_layout A list of @c PlotLayout tuples, one for each plot
+    """
+    if not len(times):
+        return
 
-def print_data(times, data):
+    order = [chan for plot in plot_layout for chan in plot.chans]
+    np.savetxt(sys.stdout, np.column_stack((times, data[order].T)),
+               fmt="%.3f," + "%.2f," * len(order))
+
+
+async def sample_loop(turbo, queue, channels, start_time, data_period,
+                      executor):
     """!
-    This function prints (or displays) a set of turbine data.
-    @param times A list of times
-    @param data The list of lists of lists holding the data
+    Read all the ADC channels once every data period and put the raw
+    readings into a queue, from which store_loop() saves them. The blocking
+    I2C reads are run in a worker thread so the GUI and plotting aren't held
+    up while the ADC is converting. If the queue is full because saving has
+    fallen behind, the oldest sample in it is thrown away.
+    @param turbo The @c TurboHAT object which reads the ADC
+    @param queue The @c asyncio.Queue into which samples are put
+    @param channels A list of the ADC channel numbers to read
+    @param start_time The time at which the program began
+    @param data_period The time between data acquisitions in seconds
+    @param executor The executor which runs the I2C reads
     """
-    for index in range(len(times)):
-        print ("{:.3f},".format (times[index]), end='')
-        for plot in data:
-            for channel in plot:
-                print ("{:.2f},".format (channel[index]), end='')
-        print ("")
+    loop = asyncio.get_running_loop()
+    next_data_time = 0.0           # Time to take the next data point
 
+    while True:
+        # Read all the channels in one scan
+        sample_time = time.monotonic() - start_time
+        raw = await loop.run_in_executor(executor, turbo.read_channels,
+                                         channels)
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait((sample_time, raw))
+
+        # Sleep until it's time to acquire some more data
+        next_data_time += data_period
+        await asyncio.sleep(max(0.0, next_data_time
+                                     - (time.monotonic() - start_time)))
+
+
+async def store_loop(queue, window, samples, channels, calibrations,
+                     new_data):
+    """!
+    Take samples from the queue, calibrate them and save them in the sample
+    buffer. All the samples waiting in the queue are saved together, then
+    the channel reading boxes are updated and the plots told to redraw once.
+    @param queue The @c asyncio.Queue from which samples are taken
+    @param window The main window, holding the channel reading boxes
+    @param samples The @c SampleBuffer in which data is saved
+    @param channels A list of the ADC channel numbers which are read
+    @param calibrations An array of calibration factors for each ADC channel
+    @param new_data An @c asyncio.Event set when new data has been saved
+    """
+    channel_calibrations = calibrations[channels]
 
-def main():
+    while True:
+        batch = [await queue.get()]
+        while not queue.empty():
+            batch.append(queue.get_nowait())
+
+        # Calibrate the whole batch with one multiply. The raw readings are
+        # 16 bit integers and the calibrations 32 bit floats, so the result
+        # is 32 bit floats without a 64 bit copy being made along the way
+        sample_times, raws = zip(*batch)
+        readings = np.array(raws) * channel_calibrations
+        for sample_time, sample in zip(sample_times, readings):
+            samples.append(sample_time, sample)
+
+        for channel_number, channel_data in zip(channels, readings[-1]):
+            # Also update the channel reading boxes
+            window["-CH{:d}-".format(channel_number)].update(
+                "{:.3f}".format(channel_data))
+        new_data.set()
+
+
+async def draw_loop(samples, canvases, line_artists, plot_layout,
+                    plot_windows, new_data, executor, redraw_period,
+                    redraw_samples):
+    """!
+    Redraw the plots when new data has been acquired, but no more often than
+    once each redraw period unless many new samples have piled up. A new
+    drawing isn't started until the previous one has been rendered, so
+    samples which arrive while rendering is slow are all shown on the next
+    drawing.
+    @param samples The @c SampleBuffer holding the data
+    @param canvases A list of canvases on which the plots are rendered
+    @param line_artists A list of lists of lines from build_plots()
+    @param plot_layout A list of @c PlotLayout tuples, one for each plot
+    @param plot_windows The screen elements on which the plots are drawn
+    @param new_data An @c asyncio.Event set when new data has been saved
+    @param executor The executor which renders the plots
+    @param redraw_period The shortest time between redraws in seconds
+    @param redraw_samples The number of new samples which causes a redraw
+           even if the redraw period isn't up
+    """
+    buffers = [io.BytesIO() for canv in canvases]
+    last_draw_time = None
+    last_draw_total = 0
+    while True:
+        await new_data.wait()
+        new_data.clear()
+
+        # Wait for the rest of the redraw period, or until enough samples
+        # have come in, before drawing again
+        if last_draw_time is not None:
+            while samples.total() - last_draw_total < redraw_samples:
+                wait_time = last_draw_time + redraw_period - time.monotonic()
+                try:
+                    await asyncio.wait_for(new_data.wait(), wait_time)
+                except asyncio.TimeoutError:
+                    break
+                new_data.clear()
+
+        last_draw_time = time.monotonic()
+        last_draw_total = samples.total()
+        update_plots(line_artists, plot_layout, *samples.get())
+        renders = draw_figures(canvases, buffers, plot_windows, executor)
+        await asyncio.gather(*[asyncio.wrap_future(rend) for rend in renders])
+
+
+async def gui_loop(window, samples, plot_layout, gui_period, tasks):
+    """!
+    Handle the buttons in the main window until the user exits or one of
+    the background tasks stops.
+    @param window The main window
+    @param samples The @c SampleBuffer holding the data
+    @param plot_layout A list of @c PlotLayout tuples, one for each plot
+    @param gui_period The time between checks for GUI events in seconds
+    @param tasks The background tasks which acquire and plot data
+    """
+    while True:
+        event, values = window.read(timeout=0)
+
+        # If the program is exiting, break out of the event loop
+        if event == 'Exit' or event == sg.WIN_CLOSED:
+            break
+
+        # The background tasks only stop if something went wrong, such as
+        # the ADC not answering; there's no point carrying on without them
+        if any(task.done() for task in tasks):
+            break
+
+        # If a plot has been rendered in the background, show it
+        if event == PLOT_READY_EVENT:
+            image, key = values[event]
+            window[key].update(data=image)
+
+        # If the 'Clear' button was pressed, empty the data arrays
+        # except for the most recent point(s)
+        if event == 'Clear':
+            samples.clear()
+
+        # If the 'Save Data' button was pressed, do it
+        if event == "Save Data":
+            print_data(*samples.get(), plot_layout)
+
+        await asyncio.sleep(gui_period)
+
+
+async def main():
     """!
     Run the program.
     """
     data_period = 1.0              # Time between data acquisitions in seconds
-    start_time = time.time()       # Save starting time for relative timing
-    next_data_time = 0.0           # Time to take the next data point
+    queue_size = 1024              # Samples waiting to be saved, at most
+    history = 3600                 # Number of data points kept for plotting
+    gui_period = 0.05              # Time between checks for button presses
+    redraw_period = 2.0            # Time between plot redraws in seconds
+    redraw_samples = 100           # New samples which force an early redraw
+    start_time = time.monotonic()  # Save starting time for relative timing
 
     # Set up the power measurement hardware
     i2c_bus = SMBus (1)
     turbo = TurboHAT (i2c_bus, i2c_address=0x40, reset_pin=12, drdy_pin=16)
 
-    # Create some arrays (well, lists) for time and voltage data. Times
-    # are a simple array. Data is arranged as an array of subplots, each
-    # of which contains a list of channels. Variables 'data', 'channels',
-    # and 'legends' must have matching dimensions
-    times = []
-    data = [[[], []], [[], []]]
-    channels = [[0, 2], [1, 3]]
-    legends = [['Turbine 1 Voltage', 'Turbine 1 Current'],
-               ['Turbine 2 Voltage', 'Turbine 2 Current']]
+    # Create ring buffers for time and voltage data. Times are a simple
+    # array. Data is arranged as one row for each ADC channel, 0 through 3
+    # in order, which is the order in which the channels are read. Each
+    # plot shows some of the rows; in each plot layout, 'chans' and
+    # 'legends' must have matching lengths
+    channels = [0, 1, 2, 3]
+    samples = SampleBuffer((len(channels),), history)
+    plot_layout = [PlotLayout([0, 2], "Ch 0,2 V", "Turbine 1",
+                              ['Turbine 1 Voltage', 'Turbine 1 Current']),
+                   PlotLayout([1, 3], "Ch 1,3 V", "Turbine 2",
+                              ['Turbine 2 Voltage', 'Turbine 2 Current'])]
     x_label = "Time (s)"
-    y_labels = ["Ch 0,2 V", "Ch 1,3 V"]          # One per subplot
-    plot_titles = ["Turbine 1", "Turbine 2"]
     plots_title = "Wind Turbine Power"
 
-    # Specify calibration for each ADC channel; this flat list just
+    # Specify calibration for each ADC channel; this flat array just
     # gives numbers for channels 0 through 3 in order
-    calibrations = [5.0 / 32768, 5.0 / 32768, 5.0 / 32768, 5.0 / 32768]
+    calibrations = np.array([5.0 / 32768, 5.0 / 32768, 5.0 / 32768,
+                             5.0 / 32768], dtype=np.float32)
 
-    # Make a flat list of channels and a set of columns for printing 'em.
-    # The columns must be in a list of lists of lists. Really
-    flat_channels = [item for sublist in channels for item in sublist]
+    # Make a set of columns for printing the channels' readings. The
+    # columns must be in a list of lists of lists. Really
     chan_labs = [[[sg.Text("Ch. {:d}".format(num), size=(16, 1),
                            font=("Helvetica", 12), justification="center")
-                   for num in flat_channels]]]
+                   for num in channels]]]
     chan_cols = [[[sg.Text(key="-CH{:d}-".format(num), size=(16, 1),
                            font=("Helvetica", 12), justification="center")
-                   for num in flat_channels]]]
+                   for num in channels]]]
 
     # Choose a theme for the plots, or don't for the boring default
     sg.theme ("DarkGrey5")
@@ -142,7 +443,7 @@ def main():
 
     # The place where the plots will go
     layout.append([[sg.Image(key="-PLOT{:d}-".format(plot_num))
-                  for plot_num in range(len(data))]])
+                  for plot_num in range(len(plot_layout))]])
 
     # A row of control buttons
     layout.append([[sg.Button("Clear"),
@@ -153,66 +454,56 @@ def main():
     window = sg.Window("Turbine Power", layout)
 
     # Make a list of plot windows; it's used when drawing plots onscreen
-    plot_windows = [window['-PLOT{:d}-'.format(x)] for x in range(len(data))]
-
-    # ------------------------------------------------------------------------
-    # Run the event loop with a timer so data is read every second
-    while True:
-        event, values = window.read(timeout=1000)
+    plot_windows = [window['-PLOT{:d}-'.format(x)]
+                    for x in range(len(plot_layout))]
 
-        # If the program is exiting, break out of the event loop
-        if event == 'Exit' or event == sg.WIN_CLOSED:
-            break
+    # Make the plots once; after this only the data in them is changed
+    _, canvases, line_artists = build_plots(plot_layout, xlabel=x_label,
+                                            title=plots_title)
 
-        # If the 'Clear' button was pressed, empty the data arrays
-        # except for the most recent point(s)
-        if event == 'Clear':
-            try:
-                del times[:-1]
-                for subplot in data:
-                    for oneplot in subplot:
-                        del oneplot[:-1]
-            except IndexError:
-                print ("Attempt to clear empty data arrays")
-                pass
+    # ------------------------------------------------------------------------
+    # Acquire data and draw plots in the background while the event loop
+    # takes care of the buttons. Samples go through a queue so that slow
+    # saving or plotting doesn't hold up reading the ADC. Plots are rendered
+    # one at a time in a separate thread, as Matplotlib's font handling isn't
+    # thread safe
+    queue = asyncio.Queue(maxsize=queue_size)
+    new_data = asyncio.Event()
+    read_pool = ThreadPoolExecutor(max_workers=1)
+    render_pool = ThreadPoolExecutor(max_workers=1)
+    tasks = [asyncio.create_task(
+                 sample_loop(turbo, queue, channels, start_time, data_period,
+                             read_pool)),
+             asyncio.create_task(
+                 store_loop(queue, window, samples, channels, calibrations,
+                            new_data)),
+             asyncio.create_task(
+                 draw_loop(samples, canvases, line_artists, plot_layout,
+                           plot_windows, new_data, render_pool,
+                           redraw_period, redraw_samples))]
+
+    try:
+        await gui_loop(window, samples, plot_layout, gui_period, tasks)
+
+    finally:
+        # Stop the background tasks, then wait for any ADC read or plot
+        # render still running in a worker thread before cleaning up the
+        # things it's using
+        for task in tasks:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        read_pool.shutdown()
+        render_pool.shutdown()
+
+        # Clean things up when exiting the program
+        turbo.clean_up()
+        window.close()
+
+    # If a background task stopped because of an error, report it
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
 
-        # If the 'Save Data' button was pressed, do it
-        if event == "Save Data":
-            print_data(times, data)
-
-        else:
-            # Check that it's time to acquire some more data
-            now_time = time.time() - start_time
-            if now_time > next_data_time:
-                next_data_time += data_period
-
-                # Presumably this means the timer has gone off; get
-                # data and plot it
-                times.append(time.time() - start_time)
-                for subplot in range(len(data)):
-                    for chan in range(len(data[subplot])):
-                        # For each channel, read data, calibrate and save
-                        channel_number = (channels[subplot])[chan]
-                        channel_data = turbo.read_channel(channel_number)
-                        channel_data *= calibrations[channel_number]
-                        (data[subplot])[chan].append(channel_data)
-                        # Also update the channel reading boxes
-                        window["-CH{:d}-".format(channel_number)].update(
-                            "{:.3f}".format(channel_data))
-
-                draw_figures(create_plots(times, data,
-                                          xlabel=x_label,
-                                          ylabels=y_labels,
-                                          title=plots_title,
-                                          plot_titles=plot_titles),
-                             plot_windows)
-
-    # Clean things up when exiting the program
-    turbo.clean_up()
-    window.close()
-    
 
 if __name__ == "__main__":
-    main()
-
-
+    asyncio.run(main())